@@ -1,196 +1,233 @@
 import argparse
-from bs4 import BeautifulSoup
-from enum import Enum
-from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import lru_cache
+from graphlib import CycleError, TopologicalSorter
 import os
+from pathlib import Path
 import re
-import requests
+import sys
+from requests.adapters import HTTPAdapter
+import requests_cache
+import threading
+from urllib3.util.retry import Retry
 
-CRAN_PACKAGE_URL_FORMAT = "https://cran.r-project.org/web/packages/{package}/index.html"
+# Fetch from the RStudio mirror rather than cran.r-project.org, which asks not to be scraped
+CRAN_PACKAGE_URL_FORMAT = "https://cran.rstudio.com/web/packages/{package}/DESCRIPTION"
 
+# Bioconductor publishes the DESCRIPTION fields of every package in each of its repositories as a
+# single VIEWS file, so we can look up all of them at once instead of package by package
+BIOC_VIEWS_URLS = [
+    "https://bioconductor.org/packages/release/bioc/VIEWS",
+    "https://bioconductor.org/packages/release/data/annotation/VIEWS",
+    "https://bioconductor.org/packages/release/data/experiment/VIEWS",
+]
 
-def get_cran_url(package_name: str) -> str:
-    return CRAN_PACKAGE_URL_FORMAT.format(package=package_name)
+# Packages that ship with R itself, which aren't on CRAN and never need to be installed
+BASE_PACKAGES = frozenset(['R', 'base', 'compiler', 'datasets', 'graphics', 'grDevices', 'grid',
+                           'methods', 'parallel', 'splines', 'stats', 'stats4', 'tcltk', 'tools',
+                           'utils'])
 
+# Matches the dependency fields of a DESCRIPTION file, along with their indented continuation lines
+DEPENDENCY_FIELD_REGEX = re.compile(r'^(?:Imports|Depends|LinkingTo):(.*?)(?=^\S|\Z)',
+                                    re.MULTILINE | re.DOTALL)
 
-def get_table_row(table, td_text):
-    """ Find a row in a table that has td_text as one column's text """
-    td = table.find('td', string=td_text)
+# Matches the package name at the start of every comma-separated dependency in a field, ignoring
+# any version requirements
+PACKAGE_NAME_REGEX = re.compile(r'(?:^|,)\s*([A-Za-z][A-Za-z0-9.]*)')
 
-    if td is None:
-        return None
+# Matches the name of the package that a VIEWS record describes
+VIEWS_PACKAGE_REGEX = re.compile(r'^Package:\s*(\S+)', re.MULTILINE)
 
-    return td.find_parent('tr')
+# The number of packages to fetch at the same time
+MAX_WORKERS = 16
 
+# Where cranlock keeps its caches between runs
+CACHE_DIRECTORY = os.path.expanduser("~/.cache/cranlock")
 
-# Cache the responses for all CRAN URLs we have visited, since a package often appears more than
-# once in a dependency tree.
-url_cache = dict()
+# Share a single session between all requests so that connections are kept alive and
+# reused instead of paying for a new TLS handshake for every package. Responses are cached on disk
+# for a day, so rerunning cranlock doesn't download every page again. The session is only created
+# once we first fetch something, so importing cranlock never touches the cache directory.
+session = None
+session_lock = threading.Lock()
 
 
-def get_info_table(package: str):
-    """Get the HTML table from the CRAN site for a package, which holds all the dependency info"""
-    url = get_cran_url(package)
-    if url_cache.get(url, None):
-        response = url_cache[url]
-    else:
-        response = requests.get(url)
-        url_cache[url] = response
+def get_session():
+    """Get the shared session, creating it the first time this is called"""
+    global session
 
-    if response.status_code != 200:
-        raise Exception("Package {} does not exist on CRAN".format(package))
+    with session_lock:
+        if session is None:
+            session = requests_cache.CachedSession(
+                cache_name=os.path.join(CACHE_DIRECTORY, "http"), backend='sqlite',
+                expire_after=timedelta(days=1), allowable_codes=(200, 404))
+            session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                                                  max_retries=Retry(total=3, backoff_factor=0.3)))
 
-    soup = BeautifulSoup(response.text, 'html.parser')
+    return session
 
-    # Dependency information lives in an html table called 'Package $PKGNAME summary'
-    return soup.find('table', summary=re.compile('Package [\\w\\W]+ summary'))
 
+def get_cran_url(package_name: str) -> str:
+    return CRAN_PACKAGE_URL_FORMAT.format(package=package_name)
 
-def get_dependencies(package: str):
-    """ Get all of the packages that a package `depends` or `imports` whose names are links.
-    (If their names aren't links, they're base packages that we don't need to worry about)
-    """
 
-    table = get_info_table(package)
+def parse_description(description: str) -> tuple:
+    """Parse all of the packages that a package depends on, imports or links to out of its
+    DESCRIPTION file, skipping base packages that we don't need to worry about
+    """
+    dependencies = []
+    for field in DEPENDENCY_FIELD_REGEX.finditer(description):
+        dependencies.extend(name for name in PACKAGE_NAME_REGEX.findall(field.group(1))
+                            if name not in BASE_PACKAGES)
 
-    imports_row = get_table_row(table, "Imports:")
-    depends_row = get_table_row(table, "Depends:")
+    # A package can show up in more than one field, e.g. in both Imports and LinkingTo
+    return tuple(dict.fromkeys(dependencies))
 
-    imports = imports_row.find_all('a') if imports_row is not None else []
-    depends = depends_row.find_all('a') if depends_row is not None else []
 
-    return list(map(lambda a: a.string, imports + depends))
+def parse_views(views: str) -> dict:
+    """Parse a Bioconductor VIEWS file into the dependencies of every package it describes"""
+    manifest = dict()
 
+    # Each package gets its own record, and records are separated by blank lines
+    for record in views.split("\n\n"):
+        match = VIEWS_PACKAGE_REGEX.search(record)
+        if match is not None:
+            manifest[match.group(1)] = parse_description(record)
 
-# Cache the dependencies for every dependency, because packages often appear multiple times in
-# the depedency tree.
-dependencies_cache = dict()
+    return manifest
 
 
-def get_all_dependencies(package: str):
-    """Recursively finds all the dependencies of a package, and builds up a dependency tree"""
-    if dependencies_cache.get(package, None) is not None:
-        return dependencies_cache[package]
+# The dependencies of every Bioconductor package, which is only fetched once we first need it
+bioconductor_manifest = None
+bioconductor_manifest_lock = threading.Lock()
 
-    first_level_dependencies = get_dependencies(package)
 
-    # Construct a dict from a list of tuples so that the reducer doesn't mutate anything
-    return dict(reduce(lambda deps, dependency:
-                       deps + [(dependency, get_all_dependencies(dependency))],
-                       first_level_dependencies, []))
+def get_bioconductor_manifest() -> dict:
+    """Get the dependencies of every Bioconductor package from the VIEWS files, downloading them
+    the first time this is called"""
+    global bioconductor_manifest
 
+    with bioconductor_manifest_lock:
+        if bioconductor_manifest is None:
+            manifest = dict()
+            for url in BIOC_VIEWS_URLS:
+                response = get_session().get(url, timeout=30)
+                response.raise_for_status()
+                manifest.update(parse_views(response.text))
 
-def add_to_graph(graph: dict, dependency_tree):
-    """Add a dependency tree to our depedency graph recursively. This truns the tree into a
-    (hopefully) directed acyclic graph that we can sort using a depth-first search.
-    """
-    if len(dependency_tree.keys()) == 0:
-        return
+            bioconductor_manifest = manifest
 
-    for dep, nesteds in dependency_tree.items():
+    return bioconductor_manifest
 
-        if graph.get(dep, None) is None:
-            graph[dep] = set()
 
-        if nesteds == {}:
-            continue
+# The packages that weren't on CRAN and were found on Bioconductor instead
+bioconductor_packages = set()
 
-        for nested in nesteds.keys():
-            graph[dep].add(nested)
 
-        add_to_graph(graph, nesteds)
+# Cache the dependencies for every package, because packages often appear multiple times in
+# the depedency tree.
+@lru_cache(maxsize=None)
+def get_dependencies(package: str) -> tuple:
+    """ Get the direct dependencies of a package, without recursing into their own dependencies.
+    Most packages live on CRAN, so we try it first and only fall back to the Bioconductor manifest
+    if CRAN doesn't have the package.
+    """
+    response = get_session().get(get_cran_url(package), timeout=10)
+    if response.status_code == 200:
+        return parse_description(response.text)
+    elif response.status_code != 404:
+        response.raise_for_status()
 
+    manifest = get_bioconductor_manifest()
+    if package not in manifest:
+        raise Exception("Package {} does not exist on CRAN or Bioconductor".format(package))
 
-def get_dependency_graph(packages: [str]):
-    """Get the dependency graph for a list of packages by getting the tree for each one then
-    adding them to a graph using `add_to_graph`"""
-    dependencies = dict(map(lambda package: (package, get_all_dependencies(package)), packages))
+    with bioconductor_manifest_lock:
+        bioconductor_packages.add(package)
 
-    graph = {}
-    add_to_graph(graph, dependencies)
-    return graph
+    return manifest[package]
 
 
-class Mark(Enum):
-    Permanent = 0
-    Temporary = 1
-    Empty = 2
+def get_dependency_graph(packages: [str]):
+    """Get the dependency graph for a list of packages. The graph is walked breadth-first, and
+    every package in the current level is fetched concurrently. Each package maps to a tuple of its
+    direct dependencies in the order they're declared, rather than a set, so that sorting the graph
+    gives the same order on every run."""
+    graph = {}
 
+    frontier = list(dict.fromkeys(packages))
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        while frontier:
+            # Use a dict as an ordered set so that the graph is built in a stable order
+            next_frontier = dict()
+            for package, dependencies in zip(frontier, executor.map(get_dependencies, frontier)):
+                graph[package] = dependencies
+                next_frontier.update(dict.fromkeys(dependencies))
 
-def get_first_unvisited(visited: dict) -> str:
-    """Get the first unvisited node in the graph, or None if we've visited all of them"""
-    for (key, mark) in visited.items():
-        if mark == Mark.Empty:
-            return key
+            frontier = [package for package in next_frontier if package not in graph]
 
-    return None
+    return graph
 
 
-def visit(graph, node, visited, output):
-    """Visit a node in a depth-first search"""
-    mark = visited[node]
-    if mark == Mark.Permanent:
-        return
-    elif mark == Mark.Temporary:
+def sort_dependency_graph(graph: dict):
+    """Sort the dependency graph into a list using graphlib. Each package's dependencies are its
+    predecessors in the graph, so every package comes after all of its dependencies. The list is
+    already in the order the packages need to be installed in, with the requested packages towards
+    the end.
+    """
+    try:
+        return list(TopologicalSorter(graph).static_order())
+    except CycleError:
         # This should (hopefully) never happen because package dependencies *shouldn't* have cycles
         raise Exception("Somehow, the dependency graph is not directed and acyclic")
 
-    visited[node] = Mark.Temporary
-
-    for child_node in graph[node]:
-        visit(graph, child_node, visited, output)
-
-    visited[node] = Mark.Permanent
-
-    # Append the nodes, rather than adding them to the head, because we want to install
-    # dependencies before their dependents
-    output.append(node)
-
-
-def sort_dependency_graph(graph: dict):
-    """Sort the dependency graph into a list using depth-first search"""
-    visited = dict.fromkeys(graph.keys(), Mark.Empty)
-
-    output = []
-
-    node = get_first_unvisited(visited)
-    while node is not None:
-        visit(graph, node, visited, output)
-
-        visited[node] = True
-
-        node = get_first_unvisited(visited)
-
-    return output
-
 
 def extract_name_and_version(input_line: str) -> (str, str):
     """Extract the name and version of a package from an input line from a versions.tsv file.
     The file format is TSV, with the name in the first column and the version in the second
     """
-    info = list(filter((lambda s: len(s) > 0), input_line.strip().split('\t')))
-    name = info[0]
-    version = info[1]
+    name, version = input_line.split()[:2]
     return (name, version)
 
 
 def main(input_file, version_file, output_file):
-    # Get the requested version of every package using extract_name_and_version
-    versions = dict(map(extract_name_and_version, version_file))
+    # Get the requested version of every package using extract_name_and_version, skipping any
+    # blank lines
+    versions = dict(extract_name_and_version(line) for line in version_file if line.strip())
 
-    # Build a dependency graph from all the requested dependencies then sort it
+    # Build a dependency graph from all the requested dependencies then sort it into install order
     graph = get_dependency_graph([line.strip() for line in input_file])
     sorted_packages = sort_dependency_graph(graph)
 
-    # Write the output file
-    output_file.write("# Generated from cranlock\n")
-    output_file.write("options(warn=2)\n")
-    output_file.write("options(Ncpus=parallel::detectCores())\n")
-    output_file.write("options(repos=structure(c(CRAN=\"https://cran.revolutionanalytics.com\")))\n")
-    for package in sorted_packages:
-        if package in versions:
-            output_file.write("devtools::install_version('{package}', version='{version}')\n".format(
-                package=package, version=versions[package]))
+    # Only packages with a known version are installed
+    to_install = [package for package in sorted_packages if package in versions]
+
+    # Bioconductor packages can't be installed with devtools::install_version, so they get the
+    # current Bioconductor release instead of being pinned
+    unpinned = [package for package in to_install if package in bioconductor_packages]
+    if unpinned:
+        print("Warning: Bioconductor packages can't be pinned to a version, so the current "
+              "release of these will be installed: {}".format(", ".join(unpinned)),
+              file=sys.stderr)
+
+    # Build up the whole output file, then write it in one go
+    lines = [
+        "# Generated from cranlock\n",
+        "options(warn=2)\n",
+        "options(Ncpus=parallel::detectCores())\n",
+        "options(repos=structure(c(CRAN=\"https://cran.revolutionanalytics.com\")))\n",
+    ]
+    if unpinned:
+        lines.append("if (!requireNamespace('BiocManager', quietly=TRUE)) "
+                     "install.packages('BiocManager')\n")
+
+    lines.extend(f"BiocManager::install('{package}', update=FALSE, ask=FALSE)\n"
+                 if package in bioconductor_packages else
+                 f"devtools::install_version('{package}', version='{versions[package]}')\n"
+                 for package in to_install)
+
+    output_file.writelines(lines)
 
 
 if __name__ == "__main__":
@@ -201,7 +238,7 @@ sort the dependency graph.')
                         help='the input file for the dependencies')
     parser.add_argument('version_file', type=argparse.FileType('r'),
                         help='the file containing the version for each dependency')
-    parser.add_argument('--output-file', type=argparse.FileType('r'),
+    parser.add_argument('--output-file', type=argparse.FileType('w'),
                         help='the output file, or dependencies.R if none is specified')
 
     # Parse the arguments into variables
@@ -210,6 +247,6 @@ sort the dependency graph.')
     version_file = args.version_file
     output_file = args.output_file
     if output_file is None:
-        output_file = open(os.path.dirname(input_file) + "/dependencies.R", 'w')
+        output_file = (Path(input_file.name).parent / "dependencies.R").open('w')
 
     main(input_file, version_file, output_file)
@@ -1,11 +1,11 @@
 import argparse
+from pathlib import Path
 import subprocess
 import sys
-import os
 
 from cranlock import lock
 
-SCRIPT_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+SCRIPT_DIRECTORY = Path(__file__).resolve().parent
 
 DESCRIPTION = """
 Locks all R dependencies and transitive dependencies for reproducible builds.
@@ -27,55 +27,45 @@ The default is \'dependencies.R\' in the same directory as \'package_file\'.')
 
     # Parse arguments
     args = parser.parse_args()
-    package_file = os.path.realpath(args.package_file)
+    package_file = Path(args.package_file).resolve()
     container = args.docker_container
     # Handle fallbacks for optional arguments
-    version_file = args.version_file or os.path.dirname(package_file) + '/versions.tsv'
-    output_file = args.output_file or os.path.dirname(package_file) + '/dependencies.R'
+    version_file = Path(args.version_file or package_file.with_name('versions.tsv'))
+    output_file = Path(args.output_file or package_file.with_name('dependencies.R'))
 
     # Verify arguments
-    if not os.path.isfile(package_file):
+    if not package_file.is_file():
         print("Error: {} does not exist".format(package_file), file=sys.stderr)
         sys.exit(1)
 
-    # Get the package versions
-    package_version_command = "{dir}/get_package_versions.sh {container} > {versions}"
-    package_version_po = subprocess.Popen(package_version_command.format(dir=SCRIPT_DIRECTORY,
-                                                                         container=container,
-                                                                         versions=version_file),
-                                          shell=True, stderr=subprocess.PIPE)
-
-    for line in package_version_po.stderr:
-        print(line.decode('utf-8'), end='', file=sys.stderr)
-
-    package_version_po.wait()
-
-    if package_version_po.returncode != 0:
+    # Get the package versions. The script's stderr is passed straight through to ours, so there's
+    # no pipe that needs draining
+    try:
+        with version_file.open('w') as versions:
+            returncode = subprocess.run(
+                [SCRIPT_DIRECTORY / 'get_package_versions.sh', container],
+                stdout=versions).returncode
+    except OSError as e:
+        # The script is missing or isn't executable
+        print(e, file=sys.stderr)
+        returncode = 1
+
+    if returncode != 0:
         print("Error: could not get the package versions from the container '{}'"
               .format(container),
               file=sys.stderr)
-        if os.path.exists(version_file):
-            os.remove(version_file)
+        version_file.unlink(missing_ok=True)
         sys.exit(1)
 
     # Parse the dependency tree and generate the final R script
-    package_file = open(package_file, 'r')
-    version_file = open(version_file, 'r')
-    output_file = open(output_file, 'w')
-
     try:
-        lock.main(package_file, version_file, output_file)
+        with package_file.open('r') as packages, version_file.open('r') as versions, \
+                output_file.open('w') as output:
+            lock.main(packages, versions, output)
     except Exception as e:
         print(e)
-        package_file.close()
-        version_file.close()
-        output_file.close()
-
-        if os.path.exists(version_file):
-            os.remove(version_file)
-
-        if os.path.exists(output_file):
-            os.remove(output_file)
+        version_file.unlink(missing_ok=True)
+        output_file.unlink(missing_ok=True)
 
         sys.exit(1)
 
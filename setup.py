@@ -3,6 +3,7 @@ setup(
     name='cranlock',
     version='0.0.1',
     license="BSD-3-Clause",
+    python_requires='>=3.9',
     packages=['cranlock'],
     package_data={
         'cranlock': ['get_package_versions.sh', 'list_dependencies.R']
@@ -14,6 +15,6 @@ setup(
     },
     install_requires=[
         'requests',
-        'bs4'
+        'requests-cache'
     ],
 )
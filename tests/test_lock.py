@@ -0,0 +1,181 @@
+import io
+
+import pytest
+import requests
+
+from cranlock import lock
+
+
+GRAPH = {
+    'dplyr': ('rlang', 'ggplot2'),
+    'ggplot2': ('rlang', 'scales', 'gtable'),
+    'rlang': (),
+    'scales': ('rlang', 'farver'),
+    'gtable': (),
+    'farver': (),
+}
+
+
+def test_sort_installs_dependencies_before_dependents():
+    sorted_packages = lock.sort_dependency_graph(GRAPH)
+
+    assert sorted(sorted_packages) == sorted(GRAPH)
+    for package, dependencies in GRAPH.items():
+        for dependency in dependencies:
+            assert sorted_packages.index(dependency) < sorted_packages.index(package)
+
+
+def test_sort_order_is_stable():
+    assert lock.sort_dependency_graph(GRAPH) == [
+        'rlang', 'gtable', 'farver', 'scales', 'ggplot2', 'dplyr']
+
+
+def test_dependency_graph_keeps_declared_order(monkeypatch):
+    monkeypatch.setattr(lock, 'get_dependencies', GRAPH.__getitem__)
+
+    graph = lock.get_dependency_graph(['dplyr'])
+
+    assert graph == GRAPH
+    assert list(graph) == ['dplyr', 'rlang', 'ggplot2', 'scales', 'gtable', 'farver']
+
+
+def test_sort_rejects_cycles():
+    with pytest.raises(Exception, match="not directed and acyclic"):
+        lock.sort_dependency_graph({'a': ('b',), 'b': ('a',)})
+
+
+def test_parse_description():
+    description = """Package: ggplot2
+Version: 3.4.0
+Depends: R (>= 3.3)
+Imports: cli, glue, grDevices, grid, gtable (>= 0.1.1), lifecycle (>
+        1.0.1), MASS, rlang(>= 1.0.0), stats,
+        tibble
+Suggests: covr, dplyr
+LinkingTo: Rcpp,
+  cli
+"""
+
+    assert lock.parse_description(description) == (
+        'cli', 'glue', 'gtable', 'lifecycle', 'MASS', 'rlang', 'tibble', 'Rcpp')
+
+
+def test_parse_description_without_dependencies():
+    assert lock.parse_description("Package: rlang\nDepends: R (>= 3.5.0)\n") == ()
+
+
+def test_parse_views():
+    views = """Package: Biobase
+Version: 2.58.0
+Depends: R (>= 2.10), BiocGenerics(>= 0.27.1), utils
+Imports: methods
+
+Package: BiocGenerics
+Version: 0.44.0
+Depends: R (>= 4.0.0), methods, utils, graphics, stats
+
+Package: limma
+Imports: grDevices, graphics, stats, utils, methods, statmod
+"""
+
+    assert lock.parse_views(views) == {
+        'Biobase': ('BiocGenerics',),
+        'BiocGenerics': (),
+        'limma': ('statmod',),
+    }
+
+
+class StubResponse:
+    def __init__(self, status_code, text=""):
+        self.status_code = status_code
+        self.text = text
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError("{} error".format(self.status_code))
+
+
+class StubSession:
+    """Serves canned responses by URL, and 404s for anything else"""
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def get(self, url, timeout=None):
+        return self.pages.get(url, StubResponse(404))
+
+
+def cran_page(description):
+    return StubResponse(200, description)
+
+
+BIOC_VIEWS = """Package: Biobase
+Depends: R (>= 2.10), BiocGenerics(>= 0.27.1), utils
+
+Package: BiocGenerics
+Depends: R (>= 4.0.0), methods
+"""
+
+PAGES = {
+    lock.get_cran_url('dplyr'): cran_page("Package: dplyr\nImports: rlang, Biobase\n"),
+    lock.get_cran_url('rlang'): cran_page("Package: rlang\nDepends: R (>= 3.5.0)\n"),
+    lock.get_cran_url('broken'): StubResponse(500),
+    lock.BIOC_VIEWS_URLS[0]: StubResponse(200, BIOC_VIEWS),
+    lock.BIOC_VIEWS_URLS[1]: StubResponse(200, ""),
+    lock.BIOC_VIEWS_URLS[2]: StubResponse(200, ""),
+}
+
+
+@pytest.fixture
+def stub_session(monkeypatch):
+    monkeypatch.setattr(lock, 'session', StubSession(PAGES))
+    monkeypatch.setattr(lock, 'bioconductor_manifest', None)
+    monkeypatch.setattr(lock, 'bioconductor_packages', set())
+    lock.get_dependencies.cache_clear()
+    yield
+    lock.get_dependencies.cache_clear()
+
+
+def test_get_dependencies_from_cran(stub_session):
+    assert lock.get_dependencies('dplyr') == ('rlang', 'Biobase')
+
+    # Packages on CRAN never need the Bioconductor manifest
+    assert lock.bioconductor_manifest is None
+    assert lock.bioconductor_packages == set()
+
+
+def test_get_dependencies_falls_back_to_bioconductor(stub_session):
+    assert lock.get_dependencies('Biobase') == ('BiocGenerics',)
+    assert lock.bioconductor_packages == {'Biobase'}
+
+
+def test_get_dependencies_of_missing_package(stub_session):
+    with pytest.raises(Exception, match="does not exist on CRAN or Bioconductor"):
+        lock.get_dependencies('nonexistent')
+
+
+def test_get_dependencies_raises_cran_errors(stub_session):
+    with pytest.raises(requests.HTTPError):
+        lock.get_dependencies('broken')
+
+    assert lock.bioconductor_manifest is None
+
+
+def test_main_writes_install_script(stub_session, capsys):
+    output_file = io.StringIO()
+
+    lock.main(io.StringIO("dplyr\n"),
+              io.StringIO("dplyr\t1.1.0\nrlang\t1.0.6\nBiobase\t2.58.0\n\n"),
+              output_file)
+
+    assert output_file.getvalue().splitlines() == [
+        "# Generated from cranlock",
+        "options(warn=2)",
+        "options(Ncpus=parallel::detectCores())",
+        "options(repos=structure(c(CRAN=\"https://cran.revolutionanalytics.com\")))",
+        "if (!requireNamespace('BiocManager', quietly=TRUE)) install.packages('BiocManager')",
+        "devtools::install_version('rlang', version='1.0.6')",
+        "BiocManager::install('Biobase', update=FALSE, ask=FALSE)",
+        "devtools::install_version('dplyr', version='1.1.0')",
+    ]
+    assert "Biobase" in capsys.readouterr().err